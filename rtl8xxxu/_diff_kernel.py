@@ -0,0 +1,39 @@
+"""XOR-reduce kernel for diffing register dump buffers, JIT compiled if numba is available"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _xor_reduce_numpy(buffers: np.ndarray) -> np.ndarray:
+    delta = np.zeros(buffers.shape[1], dtype=np.uint8)
+    for buffer in buffers[1:]:
+        delta |= buffer ^ buffers[0]
+    return delta
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _xor_reduce_numba(buffers: np.ndarray) -> np.ndarray:
+        # Fused XOR and OR without temporaries, walking every buffer sequentially so the loop gets vectorized
+        delta = np.zeros(buffers.shape[1], dtype=np.uint8)
+        first = buffers[0]
+        for dump_index in range(1, buffers.shape[0]):
+            current = buffers[dump_index]
+            for index in range(buffers.shape[1]):
+                delta[index] |= current[index] ^ first[index]
+        return delta
+
+
+def xor_reduce(buffers: np.ndarray) -> np.ndarray:
+    """
+    Bits differing from the first buffer in any of the other buffers.
+
+    :param buffers: One row of uint8 per dump
+    :return: One uint8 per column
+    """
+    if njit is not None:
+        return _xor_reduce_numba(buffers)
+    return _xor_reduce_numpy(buffers)
@@ -1,13 +1,55 @@
+import collections
 import dataclasses
+import functools
+import hashlib
+import itertools
 import math
 import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import sqlite3
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from multiprocessing import Pool
-from typing import Iterable
+from typing import Iterable, List, Dict, Optional, Tuple
 
-import pyshark
+import dpkt
+
+COUNT_CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                'rtl8xxxu-analyze', 'counts.sqlite')
+
+# All display filters only reference wlan and wlan_radio fields, dissecting upper layers is wasted time
+TSHARK_DISABLED_PROTOCOLS = ['ip', 'ipv6', 'tcp', 'udp', 'http', 'http2']
+_TSHARK_DISABLE_PROTOCOL_ARGS = [arg for protocol in TSHARK_DISABLED_PROTOCOLS
+                                 for arg in ('--disable-protocol', protocol)]
+
+# Reading captures in large chunks makes for far fewer read() calls than the default buffer of a few KiB
+PCAP_READ_BUFFER_SIZE = 1 << 20
+
+_META_RE = re.compile(r'^(?P<driver>8192cu|rtl8192cu|rtl8xxxu)(?:-(?P<version>[^:]+))?-'
+                      r'(?P<sta_mac>(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})?-?(?P<direction>[rt]x).pcap')
+
+
+# Values of wlan_radio.phy
+PHY_UNKNOWN = 0
+PHY_11_FHSS = 1
+PHY_11B = 4
+PHY_11A = 5
+PHY_11G = 6
+PHY_11N = 7
+PHY_11AC = 8
+
+# Radiotap channel flags (GFSK, dynamic CCK-OFDM, 5 GHz, 2 GHz, OFDM, CCK, turbo) as mapped by Wireshark
+_RADIOTAP_CHANNEL_FLAGS_MASK = 0x0df0
+_PHY_BY_RADIOTAP_CHANNEL_FLAGS = {
+    0x0880: PHY_11_FHSS,
+    0x0140: PHY_11A,
+    0x00a0: PHY_11B,
+    0x00c0: PHY_11G,
+    0x0480: PHY_11G,
+}
 
 
 @dataclasses.dataclass
@@ -29,6 +71,32 @@ class CountJobResult:
             return math.nan
 
 
+@dataclasses.dataclass(frozen=True)
+class FrameSummary:
+    """The few radiotap/802.11 header fields the counting jobs filter on"""
+    phy: int = PHY_UNKNOWN
+    retry: bool = False
+    amsdu_present: bool = False
+    category_code: Optional[int] = None
+    action_code: Optional[int] = None
+
+
+# Display filters which can be evaluated on a FrameSummary, without having tshark dissect the packets
+FAST_DISPLAY_FILTERS = {
+    '': lambda f: True,
+    'wlan.fc.retry == 1': lambda f: f.retry,
+    'wlan.qos.amsdupresent == 1': lambda f: f.amsdu_present,
+    'wlan.fixed.category_code == 3 && wlan.fixed.action_code == 0x00':
+        lambda f: f.category_code == 3 and f.action_code == 0x00,
+    'wlan.fixed.category_code == 3 && wlan.fixed.action_code == 0x01':
+        lambda f: f.category_code == 3 and f.action_code == 0x01,
+    'wlan_radio.phy == 4': lambda f: f.phy == PHY_11B,
+    'wlan_radio.phy == 6': lambda f: f.phy == PHY_11G,
+    'wlan_radio.phy == 7': lambda f: f.phy == PHY_11N,
+}
+
+
+@functools.lru_cache(maxsize=None)
 def get_metadata(input_file):
     """
     Extract relevant metadata from PCAP file name.
@@ -40,46 +108,194 @@ def get_metadata(input_file):
     """
 
     basename = os.path.basename(input_file)
-    m = re.search('^(8192cu|rtl8192cu|rtl8xxxu)(-([^:]+))?-(([0-9A-Fa-f]{2}:){5}([0-9A-Fa-f]{2}))?-?([rt]x).pcap',
-                  basename)
-    if not m:
+    if not (m := _META_RE.match(basename)):
         raise RuntimeError(f"Unexpected filename: {basename}")
 
-    return m.group(1, 3, 4, 7)
+    return m.group('driver', 'version', 'sta_mac', 'direction')
+
+
+def parse_io_stat_frames(tshark_output: str) -> List[int]:
+    """
+    Extract the number of frames from the output of "tshark -q -z io,stat,0,<filter>[,<filter>...]".
+
+    :param tshark_output: stdout of tshark
+    :return: Number of frames matching each io,stat filter, in the order the filters were given
+    """
+    rows = [line for line in tshark_output.splitlines() if '<>' in line]
+    if not rows:
+        raise RuntimeError(f"Unexpected tshark io,stat output: {tshark_output}")
+    counts = []
+    for row in rows:
+        cells = [cell.strip() for cell in row.split('|') if cell.strip()]
+        # Skip the interval, every filter has a "Frames" and a "Bytes" column
+        frames = [int(cell) for cell in cells[1::2]]
+        counts = [a + b for a, b in zip(counts, frames)] if counts else frames
+    return counts
+
+
+def _parse_radiotap_header(packet: bytes) -> Tuple[int, int]:
+    """
+    Extract the PHY type the way Wireshark derives wlan_radio.phy from a radiotap header.
+
+    :param packet: raw packet, starting with the radiotap header
+    :return: Tuple (PHY type, radiotap header length)
+    """
+    header_length = int.from_bytes(packet[2:4], byteorder='little')
+    present = int.from_bytes(packet[4:8], byteorder='little')
+    if present & (0x1 << 19):  # MCS
+        return PHY_11N, header_length
+    if present & (0x1 << 21):  # VHT
+        return PHY_11AC, header_length
+    if not present & (0x1 << 3):  # Channel
+        return PHY_UNKNOWN, header_length
+
+    # Skip extended presence bitmaps, then TSFT (8 byte aligned), flags and rate to get to the channel
+    offset = 8
+    extended_present = present
+    while extended_present & (0x1 << 31):
+        extended_present = int.from_bytes(packet[offset:offset + 4], byteorder='little')
+        offset += 4
+    if present & (0x1 << 0):
+        offset = (offset + 7) & ~7
+        offset += 8
+    offset += bool(present & (0x1 << 1)) + bool(present & (0x1 << 2))
+    offset = (offset + 1) & ~1
+    if offset + 4 > header_length:
+        return PHY_UNKNOWN, header_length
+    channel_flags = int.from_bytes(packet[offset + 2:offset + 4], byteorder='little')
+    return _PHY_BY_RADIOTAP_CHANNEL_FLAGS.get(channel_flags & _RADIOTAP_CHANNEL_FLAGS_MASK, PHY_UNKNOWN), header_length
+
+
+def _summarize_frame(packet: bytes) -> FrameSummary:
+    """Summarize a radiotap encapsulated 802.11 frame"""
+    if len(packet) < 8 or packet[0] != 0:
+        return FrameSummary()
+    phy, header_length = _parse_radiotap_header(packet)
+    frame = packet[header_length:]
+    if len(frame) < 2:
+        return FrameSummary(phy)
+
+    frame_type = (frame[0] >> 2) & 0x3
+    frame_subtype = frame[0] >> 4
+    flags = frame[1]
+    summary = {'phy': phy, 'retry': bool(flags & 0x08)}
+    if frame_type == 2 and frame_subtype & 0x8:
+        # QoS data: QoS control follows the 4th address if both "To DS" and "From DS" are set
+        qos_offset = 30 if flags & 0x03 == 0x03 else 24
+        if len(frame) > qos_offset:
+            summary['amsdu_present'] = bool(frame[qos_offset] & 0x80)
+    elif frame_type == 0 and frame_subtype in (0xd, 0xe) and not flags & 0x40:
+        # (Unprotected) action frame, HT control precedes the body if the order flag is set
+        body_offset = 28 if flags & 0x80 else 24
+        if len(frame) > body_offset + 1:
+            summary['category_code'] = frame[body_offset]
+            summary['action_code'] = frame[body_offset + 1]
+    return FrameSummary(**summary)
+
+
+def _fast_count(input_file: str, display_filters: List[str]) -> Optional[List[int]]:
+    """
+    Count packets matching FAST_DISPLAY_FILTERS in a single pass over the capture, without tshark.
+
+    :return: Number of packets per filter, None if the capture does not contain radiotap headers or is damaged
+    """
+    with open(input_file, 'rb', buffering=PCAP_READ_BUFFER_SIZE) as f:
+        try:
+            reader = dpkt.pcap.Reader(f)
+        except ValueError:
+            f.seek(0)
+            reader = dpkt.pcapng.Reader(f)
+        if reader.datalink() != dpkt.pcap.DLT_IEEE802_11_RADIO:
+            return None
+        # Only few distinct summaries exist (PHY x retry x ...), so the filters are evaluated on their histogram
+        # instead of on every packet
+        try:
+            histogram = collections.Counter(_summarize_frame(packet) for _timestamp, packet in reader)
+        except dpkt.UnpackError:
+            # E.g. cut off within a record header, leave it to tshark to make the best of it
+            return None
+    return [sum(count for summary, count in histogram.items() if FAST_DISPLAY_FILTERS[display_filter](summary))
+            for display_filter in display_filters]
 
 
 def count_packets_process(job: CountJob) -> CountJobResult:
-    count = 0
+    return count_packets_grouped_process([job])[0]
+
 
-    def count_callback(_pkt):
-        nonlocal count
-        count += 1
+def count_packets_grouped_process(jobs: List[CountJob]) -> List[CountJobResult]:
+    """Count packets for jobs sharing the same input file, decoding the file only once"""
+    if len(set(job.input_file for job in jobs)) != 1:
+        raise RuntimeError('Grouped jobs must share the same input file')
+    input_file = jobs[0].input_file
 
-    with pyshark.FileCapture(job.input_file, display_filter=job.display_filter, only_summaries=True) as capture:
-        capture.set_debug()
-        capture.apply_on_packets(count_callback)
+    if all(job.display_filter in FAST_DISPLAY_FILTERS for job in jobs):
+        display_filters = list(dict.fromkeys(job.display_filter for job in jobs))
+        if (counts := _fast_count(input_file, display_filters)) is not None:
+            count_by_filter = dict(zip(display_filters, counts))
+            return [CountJobResult(job.name, count_by_filter[job.display_filter]) for job in jobs]
 
-    return CountJobResult(job.name, count)
+    if not any(job.display_filter for job in jobs):
+        output = subprocess.run(['capinfos', '-M', '-c', input_file], check=True, capture_output=True,
+                                text=True).stdout
+        if not (m := re.search(r'^Number of packets:\s+(\d+)', output, re.MULTILINE)):
+            raise RuntimeError(f"Unexpected capinfos output: {output}")
+        return [CountJobResult(job.name, int(m.group(1))) for job in jobs]
+
+    # An empty filter counts all packets, io,stat does not accept empty filters though
+    display_filters = list(dict.fromkeys(job.display_filter or 'frame' for job in jobs))
+    # Taps are fed before the display filter (-Y) gets applied, therefore the filters have to be part of io,stat
+    io_stat = ','.join(['io,stat,0'] + display_filters)
+    output = subprocess.run(['tshark', '-n', *_TSHARK_DISABLE_PROTOCOL_ARGS, '-q', '-r', input_file, '-z', io_stat],
+                            check=True, capture_output=True, text=True).stdout
+    count_by_filter = dict(zip(display_filters, parse_io_stat_frames(output)))
+    return [CountJobResult(job.name, count_by_filter[job.display_filter or 'frame']) for job in jobs]
+
+
+def count_cache_key(job: CountJob) -> str:
+    """Key identifying a job's result for as long as its input file stays unchanged"""
+    stat = os.stat(job.input_file)
+    key = f'{os.path.realpath(job.input_file)}:{stat.st_size}:{stat.st_mtime}:{job.display_filter}'
+    return hashlib.blake2b(key.encode()).hexdigest()
+
+
+def open_count_cache(cache_file: str = COUNT_CACHE_FILE) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    connection = sqlite3.connect(cache_file)
+    connection.execute('CREATE TABLE IF NOT EXISTS counts (key TEXT PRIMARY KEY, count INTEGER)')
+    return connection
 
 
 def create_by_filter_capture(input_file: str, output_file: str, display_filter: str):
     """This implements some primitive caching mechanism. Saves 50-60% on 2nd+ run."""
     if not os.path.isfile(output_file):
-        # Using PySharks PCAP writing feature seems to break the PySharks code :/
-        subprocess.run(['tshark', '-n', '-Y', display_filter, '-w', tmp_file := output_file + '.tmp', '-r', input_file],
+        subprocess.run(['tshark', '-n', *_TSHARK_DISABLE_PROTOCOL_ARGS, '-Y', display_filter,
+                        '-w', tmp_file := output_file + '.tmp', '-r', input_file],
                        check=True)
         os.rename(tmp_file, output_file)
 
 
-def process_pcap_file(global_capture: str, ap_mac=None, dut_mac=None) -> Iterable[CountJobResult]:
-    """All of this is due Python/PyShark being slow and me not having implemented a better way to speed it up."""
-    create_by_filter_capture(global_capture, network_capture := global_capture + "-network",
-                             f'( wlan.fc.type_subtype != 0x0008) && (wlan.ta in {{{ap_mac} {dut_mac}}} || !wlan.ta)')
-    create_by_filter_capture(global_capture, by_ap_capture := network_capture + "-by-ap", f"(wlan.ta == {ap_mac})")
-    create_by_filter_capture(global_capture, by_dut_capture := network_capture + "-by-dut", f"(wlan.ta == {dut_mac})")
-    create_by_filter_capture(global_capture, by_other_capture := network_capture + "-by-other",
-                             f"wlan.ta && !(wlan.ta in {{{ap_mac} {dut_mac}}})")
-    create_by_filter_capture(global_capture, no_ta_capture := network_capture + "-no-ta", f"!wlan.ta")
+def process_pcap_file(global_capture: str, ap_mac=None, dut_mac=None,
+                      pool: Optional[multiprocessing.pool.Pool] = None) -> Iterable[CountJobResult]:
+    """
+    Count the frames of interest in a capture, split into filtered captures first to keep tshark runs short.
+
+    :param pool: Worker processes to count in, shared between captures; a pool of its own if not given
+    """
+    network_capture = global_capture + "-network"
+    by_ap_capture = network_capture + "-by-ap"
+    by_dut_capture = network_capture + "-by-dut"
+    by_other_capture = network_capture + "-by-other"
+    no_ta_capture = network_capture + "-no-ta"
+    filter_specs = [
+        (network_capture, f'( wlan.fc.type_subtype != 0x0008) && (wlan.ta in {{{ap_mac} {dut_mac}}} || !wlan.ta)'),
+        (by_ap_capture, f"(wlan.ta == {ap_mac})"),
+        (by_dut_capture, f"(wlan.ta == {dut_mac})"),
+        (by_other_capture, f"wlan.ta && !(wlan.ta in {{{ap_mac} {dut_mac}}})"),
+        (no_ta_capture, f"!wlan.ta"),
+    ]
+    # All extracts read the global capture only, the work happens in tshark so threads suffice to run them in parallel
+    with ThreadPoolExecutor(max_workers=len(filter_specs)) as executor:
+        list(executor.map(lambda spec: create_by_filter_capture(global_capture, *spec), filter_specs))
 
     jobs = [
         CountJob("global.network.amsdu_present", network_capture, "wlan.qos.amsdupresent == 1"),
@@ -107,5 +323,28 @@ def process_pcap_file(global_capture: str, ap_mac=None, dut_mac=None) -> Iterabl
         CountJob("global.retries", global_capture, "wlan.fc.retry == 1"),
     ]
 
-    with Pool(processes=multiprocessing.cpu_count()) as pool:
-        return pool.map(count_packets_process, jobs)
+    keys = [count_cache_key(job) for job in jobs]
+    with closing(open_count_cache()) as cache:
+        cached_counts = dict(cache.execute(f'SELECT key, count FROM counts WHERE key IN ({",".join("?" * len(keys))})',
+                                           keys))
+        jobs_by_input_file: Dict[str, List[CountJob]] = {}
+        for job, key in zip(jobs, keys):
+            if key not in cached_counts:
+                jobs_by_input_file.setdefault(job.input_file, []).append(job)
+
+        fresh_results = {}
+        if jobs_by_input_file:
+            if pool is None:
+                # Workers are recycled to not pile up resources across the (few, long-running) jobs
+                with Pool(processes=multiprocessing.cpu_count(), maxtasksperchild=4) as own_pool:
+                    results = list(own_pool.imap_unordered(count_packets_grouped_process, jobs_by_input_file.values()))
+            else:
+                results = list(pool.imap_unordered(count_packets_grouped_process, jobs_by_input_file.values()))
+            fresh_results = {r.name: r for r in itertools.chain.from_iterable(results)}
+            with cache:
+                cache.executemany('INSERT OR REPLACE INTO counts VALUES (?, ?)',
+                                  [(key, fresh_results[job.name].count) for job, key in zip(jobs, keys)
+                                   if key not in cached_counts])
+
+    return [CountJobResult(job.name, cached_counts[key]) if key in cached_counts else fresh_results[job.name]
+            for job, key in zip(jobs, keys)]
@@ -1,4 +1,5 @@
-MASK_NAMES_TO_IGNORE = {
+# Masks which are problematic and not relevant for RTL8188CUS, with the reason for ignoring them
+_MASK_NAMES_TO_IGNORE_DOC = {
     'SYS_CFG_SW_OFFLOAD_EN': '',
     'SYS_CFG_SPS_LDO_SEL': '',
     'SYS_CFG_TRP_BT_EN': '',
@@ -16,8 +17,8 @@ MASK_NAMES_TO_IGNORE = {
     'LEDCFG0_DPDT_SELECT': 'Not available on RTL8188CUS'
 }
 
-# Registers which are problematic and not relevant for RTL8188CUS
-REGISTER_NAMES_TO_IGNORE = {
+# Registers which are problematic and not relevant for RTL8188CUS, with the reason for ignoring them
+_REGISTER_NAMES_TO_IGNORE_DOC = {
     'REG_HOST_SUSP_CNT': 'Defined twice',
     'REG_Q0_INFO': 'Also know as REG_VOQ_INFO',
     'REG_Q1_INFO': 'Also know as REG_VIQ_INFO',
@@ -33,3 +34,7 @@ REGISTER_NAMES_TO_IGNORE = {
     'REG_FPGA0_XCD_RF_PARM': 'Covered by REG_FPGA0_X{C,D}_RF_PARM',
     'REG_RX_DMA_CTRL_8723B': 'Not available on RTL8188CUS'
 }
+
+# The parser only tests for membership
+MASK_NAMES_TO_IGNORE = frozenset(_MASK_NAMES_TO_IGNORE_DOC)
+REGISTER_NAMES_TO_IGNORE = frozenset(_REGISTER_NAMES_TO_IGNORE_DOC)
@@ -1,13 +1,27 @@
+import bisect
 import logging
 import re
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import cached_property
 from typing import Optional, Union, List, Dict
 
 import fixups
 
 log = logging.getLogger(__name__)
 
+# A single pattern for all lines of interest, found by one scan over the whole header. Registers are defined with a
+# single space after #define, fields with two spaces.
+# Every repetition of the bit list starts with 'BIT(' and ends with ' | ', so the backtracking engine can never split a
+# line in more than one way and matching stays linear in the line length, no RE2 needed.
+_RE_DEFINE = re.compile(
+    r"^[ \t]*#define "
+    r"(?:(?P<register_name>(RF6052_)?REG_[A-Z_0-9]+)\t+(?P<base_address>0x[a-f0-9]+)"
+    r"| (?:(?P<bit_name>[A-Z_0-9]+)\t+BIT\((?P<bit>[0-9]+)\)"
+    r"|(?P<mask_name>[A-Z_0-9]+)_MASK\t+(?P<mask>0x[0-9a-z]+)"
+    r"|(?P<bits_name>[A-Z_0-9]+)\t+\((?P<bits>(BIT\([0-9]+\) \| )+BIT\([0-9]+\))\)))", re.MULTILINE)
+_RE_DIGITS = re.compile(r'\d+')
+
 
 @dataclass(frozen=True)
 class RegisterSection:
@@ -37,6 +51,13 @@ class RegisterSection:
         """Number of bytes in this register section"""
         return (self.address_range_end - self.address_range_begin) * self.register_depth
 
+    def __reduce__(self):
+        # Dumps parsed in worker processes refer to the module level sections again once unpickled, instead of
+        # every dump carrying its own copy
+        if (section := NAME_TO_ANY_REGISTER_SECTION.get(self.name)) is not None and section == self:
+            return _register_section_by_name, (self.name,)
+        return RegisterSection, self.members
+
 
 REGULAR_REGISTER_SECTIONS: list[RegisterSection] = [
     RegisterSection('MAC', 0, 0x800, 1, 4, 'REG_', 16),
@@ -56,44 +77,63 @@ NAME_TO_ANY_REGISTER_SECTION = NAME_TO_REGULAR_REGISTER_SECTION | NAME_TO_RF_REG
 ALL_REGISTER_SECTIONS = REGULAR_REGISTER_SECTIONS + RF_REGISTER_SECTIONS
 
 
+def _register_section_by_name(name: str) -> RegisterSection:
+    return NAME_TO_ANY_REGISTER_SECTION[name]
+
+
 @dataclass(frozen=True)
 class PartialRegisterDescription:
     name_as_in_header: str
     base_address: int
+    # Section matching name prefix and base address, determined once on construction
+    _section: Optional[RegisterSection] = field(init=False, default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        section = next((t for t in ALL_REGISTER_SECTIONS
+                        if self.name_as_in_header.startswith(t.header_prefix)
+                        and t.address_range_begin <= self.base_address < t.address_range_end), None)
+        object.__setattr__(self, '_section', section)
 
     def __lt__(self, other) -> bool:
         return self.base_address < other.base_address
 
     def is_of_type(self, register_type: RegisterSection):
-        return self.name_as_in_header.startswith(register_type.header_prefix) and \
-               register_type.address_range_begin <= self.base_address < register_type.address_range_end
-
-    @property
+        # Identity first, sections are module level constants in all but the tests
+        if self._section is register_type or (self._section is not None and self._section == register_type):
+            return True
+        # Sections other than the module level ones are not cached
+        return (self.name_as_in_header.startswith(register_type.header_prefix)
+                and register_type.address_range_begin <= self.base_address < register_type.address_range_end)
+
+    @cached_property
     def name(self):
         """Prettified name without the prefixes used in the header"""
         if self.name_as_in_header == 'unknown':
             return self.name_as_in_header
-        for t in NAME_TO_ANY_REGISTER_SECTION.values():
-            if self.is_of_type(t):
-                return self.name_as_in_header.removeprefix(t.header_prefix)
-        raise RuntimeError(f'Not a register header name: {self.name_as_in_header}')
+        if self._section is None:
+            raise RuntimeError(f'Not a register header name: {self.name_as_in_header}')
+        return self.name_as_in_header.removeprefix(self._section.header_prefix)
 
 
 class FieldDescription:
     """Describe a (continuous) range of bits within a register. ."""
 
+    # Thousands of these per header, no per instance dict
+    __slots__ = ('name', 'bitmask', 'begin', 'end')
+
     def __init__(self, name: str, bitmask: int):
         self.name = name
         self.bitmask = bitmask
+        # Index of the lowest set bit, -1 for an empty bitmask
+        self.begin: int = (bitmask & -bitmask).bit_length() - 1
+        self.end: int = bitmask.bit_length()
 
     @classmethod
     def from_range(cls, name: str, begin: int, end: int):
         """Create MaskDescription from non-negative, zero-based indexes"""
         if end <= begin or begin < 0:
             raise ValueError(f'Illegal bit positions')
-        bitmask = 0
-        for i in range(begin, end):
-            bitmask |= 0x1 << i
+        bitmask = ((0x1 << (end - begin)) - 1) << begin
         return FieldDescription(name, bitmask)
 
     def __repr__(self) -> str:
@@ -112,16 +152,6 @@ class FieldDescription:
     def __members(self):
         return self.name, self.bitmask
 
-    @property
-    def begin(self):
-        bit_str_lsb_first = bin(self.bitmask)[::-1]
-        return bit_str_lsb_first.find("1")
-
-    @property
-    def end(self):
-        bit_str_lsb_first = bin(self.bitmask)[::-1]
-        return bit_str_lsb_first.rfind("1") + 1
-
     @property
     def size(self) -> int:
         """Size in bits - Warning: May contain "holes" with bits set to zero!"""
@@ -186,11 +216,16 @@ class RegisterDescription:
         'GPIO_OUTSTS': 'Simple write does not work'
     }
 
+    __slots__ = ('parent', 'name', 'base_address', 'length', '_field_list', '_claimed_mask')
+
     def __init__(self, parent: 'RegisterMap', name: str, base_address: int):
         self.parent = parent
         self.name = name
         self.base_address = base_address
-        self.fields = {}
+        # Number of addresses covered by this register, kept up to date by the parent when registers get added
+        self.length: int = parent.register_length(base_address)
+        self._field_list: List[FieldDescription] = []  # Sorted
+        self._claimed_mask = 0  # Bits claimed by any field in _field_list
 
     def __repr__(self):
         return self.name, self.base_address
@@ -212,19 +247,6 @@ class RegisterDescription:
         except KeyError:
             return ''
 
-    @property
-    def _next_register_description(self) -> Optional['RegisterDescription']:
-        return self.parent.next_register(self)
-
-    @property
-    def length(self) -> int:
-        """Number of addresses covered by this register"""
-        # Best guess if no next register is known
-        if self._next_register_description is None:
-            return self.parent.section.register_length_max - self.base_address % self.parent.section.register_length_max
-        return min(self.parent.section.register_length_max,
-                   self._next_register_description.base_address - self.base_address)
-
     @property
     def depth(self) -> int:
         """Number of bytes behind every address"""
@@ -240,84 +262,71 @@ class RegisterDescription:
         return (0x1 << self.size * 8) - 1
 
     def add_field(self, field_description: FieldDescription) -> None:
-        # Create dict to map each bit to its field description (or None)
-        if len(self.fields) != self.size * 8:
-            self.fields = {i: None for i in range(0, self.size * 8)}
         if self.size * 8 < field_description.end:
             raise RuntimeError(
                 f'Bit #{field_description.end - 1} of field {field_description.name} exceeds {self.size} bytes size of register "{self.name}"')
-        for i in range(field_description.begin, field_description.end):
-            if self.fields[i] is not None:
-                raise RuntimeError(
-                    f'Bit #{i} of register "{self.name}" is already claimed by field "{self.fields[i].name}"')
-            self.fields[i] = field_description
+        if overlap := field_description.bitmask & self._claimed_mask:
+            i = (overlap & -overlap).bit_length() - 1
+            claimed_by = next(f for f in self._field_list if f.bitmask & (0x1 << i))
+            raise RuntimeError(f'Bit #{i} of register "{self.name}" is already claimed by field "{claimed_by.name}"')
+        self._claimed_mask |= field_description.bitmask
+        # Kept sorted by lowest bit, equal ones in order of insertion like a stable sort would
+        bisect.insort(self._field_list, field_description)
 
     @property
     def known_bitmask(self):
-        r = 0
-        for k, v in self.fields.items():
-            if v is not None:
-                r |= 0x1 << k
-        return r
+        return self._claimed_mask
 
     @property
     def unknown_field(self) -> FieldDescription:
-        if len(self.fields) == 0:
-            return FieldDescription('unknown', (1 << self.size) - 1)
-        mask = 0
-        for offset, v in self.fields.items():
-            if v is None:
-                mask |= 0x1 << offset
-        return FieldDescription('unknown', mask)
+        return FieldDescription('unknown', self.bitmask & ~self._claimed_mask)
 
     @property
     def known_fields(self) -> List[FieldDescription]:
-        return sorted(set(x for x in self.fields.values() if x))
+        return list(self._field_list)
 
     def get_affected_fields(self, bitmask: int) -> List[FieldDescription]:
-        begin_to_field = []
-        index = 0
-        while bitmask:
-            if bitmask & (0x1 << index):
-                bitmask &= ~self.fields[index].bitmask
-                begin_to_field.append(self.fields[index])
-            index += 1
-        return begin_to_field
+        return [f for f in self._field_list if f.bitmask & bitmask]
 
 
 class RegisterMap:
     def __init__(self, section: RegisterSection):
         self.section = section
-        self._address_to_register = {x: None for x in
-                                     range(section.address_range_begin, section.address_range_end)}
+        # Sorted by base address, base addresses are kept in a parallel list for bisecting
+        self._registers: List[RegisterDescription] = []
+        self._base_addresses: List[int] = []
 
     def add_register(self, partial_register_descriptions: PartialRegisterDescription) -> RegisterDescription:
         new = RegisterDescription(self, partial_register_descriptions.name, partial_register_descriptions.base_address)
-        if (old := self._address_to_register[new.base_address]) is not None:
-            if old == new:
-                raise RuntimeError(f'Already added register "{new.name}"')
-            if old.base_address == new.base_address:
-                raise RuntimeError(f'Conflict: Register "{new.name}" vs "{old.name} at 0x{new.base_address:04x}')
-            if new.base_address < old.base_address:
-                raise RuntimeError(f'Invariant violated by register "{old.name} at 0x{new.base_address:04x}')
-        for address in range(new.base_address,
-                             new.base_address + self.section.register_length_max - new.base_address % self.section.register_length_max):
-            old = self._address_to_register[address]
-            if old is not None and new.base_address < old.base_address:
-                break
-            self._address_to_register[address] = new
+        index = bisect.bisect_left(self._base_addresses, new.base_address)
+        if index < len(self._registers) and (old := self._registers[index]).base_address == new.base_address:
+            raise RuntimeError(f'Conflict: Register "{new.name}" vs "{old.name} at 0x{new.base_address:04x}')
+        self._base_addresses.insert(index, new.base_address)
+        self._registers.insert(index, new)
+        if index > 0:
+            previous = self._registers[index - 1]
+            previous.length = self.register_length(previous.base_address)
         return new
 
+    def register_length(self, base_address: int) -> int:
+        """Number of addresses covered by a register starting at base_address"""
+        register_length_max = self.section.register_length_max
+        index = bisect.bisect_right(self._base_addresses, base_address)
+        # Best guess if no next register is known
+        if index == len(self._base_addresses):
+            return register_length_max - base_address % register_length_max
+        return min(register_length_max, self._base_addresses[index] - base_address)
+
     def next_register(self, current_register: RegisterDescription) -> Optional[RegisterDescription]:
-        for address, maybe_next_register in self._address_to_register.items():
-            if maybe_next_register is not None and maybe_next_register.base_address > current_register.base_address:
-                return maybe_next_register
+        index = bisect.bisect_right(self._base_addresses, current_register.base_address)
+        if index < len(self._registers):
+            return self._registers[index]
         return
 
     def previous_register_from_address(self, address: int) -> Optional[RegisterDescription]:
-        for maybe_address in range(address - 1, self.section.address_range_begin - 1, -1):
-            if (maybe_register := self._address_to_register[maybe_address]) is not None:
-                return maybe_register
+        index = bisect.bisect_left(self._base_addresses, address)
+        if index > 0:
+            return self._registers[index - 1]
         return
 
     @staticmethod
@@ -325,27 +334,38 @@ class RegisterMap:
                              register_type: RegisterSection) -> 'RegisterMap':
         partial_register_descriptions, field_descriptions = _parse_rtl8xxxu_reg_header_extract(
             rtl8xxxu_header_content)
-        register_map = RegisterMap(register_type)
         # Remove all register types not relevant for this register type
+        return RegisterMap._from_descriptions([r for r in partial_register_descriptions if r.is_of_type(register_type)],
+                                              field_descriptions, register_type)
+
+    @staticmethod
+    def _from_descriptions(partial_register_descriptions: List[PartialRegisterDescription],
+                           field_descriptions: List[FieldDescription],
+                           register_type: RegisterSection) -> 'RegisterMap':
+        register_map = RegisterMap(register_type)
         partial_register_descriptions = sorted(r for r in partial_register_descriptions
-                                               if r.name_as_in_header not in fixups.REGISTER_NAMES_TO_IGNORE
-                                               and r.is_of_type(register_type))
+                                               if r.name_as_in_header not in fixups.REGISTER_NAMES_TO_IGNORE)
         # Add all (relevant) registers to register map
         # Registers with longest names first to make sure we assign the proper fields.
         # Not sorting by length would cause GPIO_IO_SEL_2_GPIO09_INPUT to be assigned to register REG_GPIO_PIN_CTRL
         # instead of REG_GPIO_PIN_CTRL_2.
-        fields_remaining = set(field_descriptions)
+        # Fields sorted by name, so the fields belonging to a register (name starting with the register's name) form a
+        # contiguous slice to be found by bisecting
+        fields_sorted = sorted(set(field_descriptions), key=lambda f: f.name)
+        field_names = [f.name for f in fields_sorted]
+        field_assigned = bytearray(len(fields_sorted))
         for partial_register_description in sorted(partial_register_descriptions, key=lambda d: d.name, reverse=True):
             register = register_map.add_register(partial_register_description)
-            fields_to_assign = [f for f in fields_remaining if f.belongs_to(partial_register_description)]
-            for f in fields_to_assign:
-                register.add_field(f)
-            fields_remaining -= set(fields_to_assign)
+            prefix = partial_register_description.name
+            for i in range(bisect.bisect_left(field_names, prefix), bisect.bisect_left(field_names, prefix + '\uffff')):
+                if not field_assigned[i]:
+                    register.add_field(fields_sorted[i])
+                    field_assigned[i] = 1
         return register_map
 
     @property
     def registers_with_names(self) -> List[RegisterDescription]:
-        return sorted(set(x for x in self._address_to_register.values() if x))
+        return list(self._registers)
 
     def print(self, file=sys.stdout):
         for register in self.registers_with_names:
@@ -356,51 +376,57 @@ class RegisterMap:
                 print(f' - {field.name}: 0x{field.bitmask:04x}', file=file)
 
     def register_at_address(self, address: int):
-        if reg := self._address_to_register[address]:
-            return reg
-        previous = self.previous_register_from_address(address)
-        base_address = max(previous.base_address, address - address % self.section.register_length_max)
+        register_length_max = self.section.register_length_max
+        base_address = address - address % register_length_max
+        # A register covers all addresses up to the next register or the next register_length_max boundary. The
+        # register to check is the last one starting at or before the address.
+        if (index := bisect.bisect_right(self._base_addresses, address)) > 0:
+            previous = self._registers[index - 1]
+            if address < previous.base_address + register_length_max - previous.base_address % register_length_max:
+                return previous
+            base_address = max(previous.base_address, base_address)
         return self.add_register(PartialRegisterDescription("unknown", base_address))
 
 
 def register_maps_from_header(rtl8xxxu_header_content: Union[List[str], str]) -> Dict[str, 'RegisterMap']:
-    return {x.name: RegisterMap.from_rtl8xxxu_header(rtl8xxxu_header_content, x) for x in ALL_REGISTER_SECTIONS}
-
-
-def _parse_rtl8xxxu_reg_header_extract_register(line: str) -> Optional[PartialRegisterDescription]:
-    if match_register := re.match(f"^#define (?P<name>(RF6052_)?REG_[A-Z_0-9]+)	+(?P<base_address>0x[a-f0-9]+)",
-                                  line):
-        name = match_register.group('name')
-        if name in fixups.REGISTER_NAMES_TO_IGNORE:
-            return
-        base_address = int(match_register.group('base_address'), 16)
-        return PartialRegisterDescription(name, base_address)
+    # Parse the header once and hand every section the registers already classified on construction
+    partial_register_descriptions, field_descriptions = _parse_rtl8xxxu_reg_header_extract(rtl8xxxu_header_content)
+    registers_by_section_name: Dict[str, List[PartialRegisterDescription]] = {x.name: [] for x in ALL_REGISTER_SECTIONS}
+    for partial_register_description in partial_register_descriptions:
+        if partial_register_description._section is not None:
+            registers_by_section_name[partial_register_description._section.name].append(partial_register_description)
+    return {x.name: RegisterMap._from_descriptions(registers_by_section_name[x.name], field_descriptions, x)
+            for x in ALL_REGISTER_SECTIONS}
+
+
+def _parse_rtl8xxxu_reg_header_extract_register(match: re.Match) -> Optional[PartialRegisterDescription]:
+    name = match.group('register_name')
+    if name in fixups.REGISTER_NAMES_TO_IGNORE:
+        return
+    base_address = int(match.group('base_address'), 16)
+    return PartialRegisterDescription(name, base_address)
 
 
-def _parse_rtl8xxxu_reg_header_extract_field(line: str) -> Optional[FieldDescription]:
-    if match_bit := re.match(r"^#define {2}(?P<name>[A-Z_0-9]+)	+BIT\((?P<bit>[0-9]+)\)", line):
-        name = match_bit.group('name')
+def _parse_rtl8xxxu_reg_header_extract_field(match: re.Match) -> Optional[FieldDescription]:
+    if (name := match.group('bit_name')) is not None:
         if name in fixups.MASK_NAMES_TO_IGNORE:
             return
-        bit = int(match_bit.group('bit'))
+        bit = int(match.group('bit'))
         return FieldDescription.from_range(name, bit, bit + 1)
-    if match_mask := re.match(r"^#define {2}(?P<name>[A-Z_0-9]+)_MASK	+(?P<mask>0x[0-9a-z]+)", line):
-        name = match_mask.group('name')
+    if (name := match.group('mask_name')) is not None:
         if name in fixups.MASK_NAMES_TO_IGNORE:
             return
-        mask = int(match_mask.group('mask'), 16)
+        mask = int(match.group('mask'), 16)
         return FieldDescription(name, mask)
-    if match_bits := re.match(r"^#define {2}(?P<name>[A-Z_0-9]+)	+\((?P<bits>(BIT\([0-9]+\) \| )+BIT\([0-9]+\))\)",
-                              line):
-        name = match_bits.group('name')
-        if name in fixups.MASK_NAMES_TO_IGNORE:
-            return
-        bits = sorted([int(x) for x in re.findall(r'\d+', match_bits.group('bits'))])
-        if len(bits) != len(set(bits)):
-            raise RuntimeError(f"Duplicates in bit mask: {line}")
-        if bits[-1] - bits[0] != len(bits) - 1:
-            raise RuntimeError(f"Non-continuous mask: {line}")
-        return FieldDescription.from_range(name, bits[0], bits[-1] + 1)
+    name = match.group('bits_name')
+    if name in fixups.MASK_NAMES_TO_IGNORE:
+        return
+    bits = sorted([int(x) for x in _RE_DIGITS.findall(match.group('bits'))])
+    if len(bits) != len(set(bits)):
+        raise RuntimeError(f"Duplicates in bit mask: {match.group(0)}")
+    if bits[-1] - bits[0] != len(bits) - 1:
+        raise RuntimeError(f"Non-continuous mask: {match.group(0)}")
+    return FieldDescription.from_range(name, bits[0], bits[-1] + 1)
 
 
 def _parse_rtl8xxxu_reg_header_extract(rtl8xxxu_header_content: Union[List[str], str]) \
@@ -408,19 +434,15 @@ def _parse_rtl8xxxu_reg_header_extract(rtl8xxxu_header_content: Union[List[str],
     """
     Extract register and field description from rtl8xxxu_regs.h
     """
-    if type(rtl8xxxu_header_content) == str:
-        rtl8xxxu_header_content = rtl8xxxu_header_content.splitlines()
+    if type(rtl8xxxu_header_content) != str:
+        rtl8xxxu_header_content = '\n'.join(rtl8xxxu_header_content)
 
     registers = []
     fields = []
-    for line in rtl8xxxu_header_content:
-        line = line.strip()
-        if not line:
-            continue
-        if register := _parse_rtl8xxxu_reg_header_extract_register(line):
-            registers.append(register)
-            continue
-        if field := _parse_rtl8xxxu_reg_header_extract_field(line):
+    for match in _RE_DEFINE.finditer(rtl8xxxu_header_content):
+        if match.group('register_name') is not None:
+            if register := _parse_rtl8xxxu_reg_header_extract_register(match):
+                registers.append(register)
+        elif field := _parse_rtl8xxxu_reg_header_extract_field(match):
             fields.append(field)
-        log.debug(f'Unhandled line: {line}')
     return registers, fields
@@ -1,8 +1,6 @@
 import math
 from typing import Dict, Set, List
 
-from tabulate import tabulate
-
 from register import RegisterMap, RegisterDescription
 from register_dump import Collection
 
@@ -32,17 +30,31 @@ class RegisterDiffer:
         return result
 
     def get_mismatching_register_fields_description(self, register: RegisterDescription) -> List[Dict]:
+        return self._fields_desc(register, self.get_mismatching_register_values(register))
+
+    @staticmethod
+    def _fields_desc(register: RegisterDescription, register_values: List[int]) -> List[Dict]:
+        """Field breakdown of a register, given its value in every dump"""
+        if len(register_values) == 0:
+            return []
+
+        # Which bits disagree does not depend on the field, so compare the dumps once for all fields
+        first_register_value = register_values[0]
+        disagreeing_bits = 0
+        for register_value in register_values[1:]:
+            disagreeing_bits |= register_value ^ first_register_value
+
         result = []
-        mismatching_register_values = self.get_mismatching_register_values(register)
         for field in register.known_fields:
-            values = [field.get_value(register_value) for register_value in mismatching_register_values]
-            if len(set(values)) <= 1:
+            if not (bitmask := field.bitmask) & disagreeing_bits:
                 continue
+            # FieldDescription.get_value inlined, one mask and shift per value without a method call each
+            begin = field.begin
             result.append({
                 'name': field.name,
-                'bitmask': field.bitmask,
+                'bitmask': bitmask,
                 'nibbles': math.ceil(field.size / 4),
-                'values': values,
+                'values': [(register_value & bitmask) >> begin for register_value in register_values],
                 'hint': ''
             })
 
@@ -51,28 +63,27 @@ class RegisterDiffer:
             return []
 
         unknown_field = register.unknown_field
-        values = [unknown_field.get_value(register_value) for register_value in mismatching_register_values]
-        if len(set(values)) > 1 or True:
-            result.append({
-                'name': unknown_field.name,
-                'bitmask': unknown_field.bitmask,
-                'nibbles': register.size * 2,
-                'values': values,
-                'hint': ''
-            })
+        result.append({
+            'name': unknown_field.name,
+            'bitmask': unknown_field.bitmask,
+            'nibbles': register.size * 2,
+            'values': [unknown_field.get_value(register_value) for register_value in register_values],
+            'hint': ''
+        })
         return result
 
     def get_mismatching(self):
         """Nested dictionary with all relevant information for comparing register dumps"""
         result = {}
         for register in self.get_mismatching_registers():
+            register_values = self.get_mismatching_register_values(register)
             register_dict = {
                 'name': register.name,
                 'bitmask': register.bitmask,
                 'nibbles': register.size * 2,
-                'values': self.get_mismatching_register_values(register),
+                'values': register_values,
                 'hint': register.hint,
-                'fields': self.get_mismatching_register_fields_description(register)
+                'fields': self._fields_desc(register, register_values)
             }
             result[register.base_address] = register_dict
         return result
@@ -101,4 +112,14 @@ class RegisterDiffer:
                 rows[-1] += [f'0x{field_value:0{field["nibbles"]}X}' for field_value in field['values']]
                 rows[-1] += [field['hint']]
 
-        print(tabulate(rows, headers=header, tablefmt='orgtbl'))
+        print_orgtbl(rows, header)
+
+
+def print_orgtbl(rows: List[List[str]], header: List[str]):
+    """Print rows of strings as left-aligned org-mode table, like tabulate(..., tablefmt='orgtbl') would"""
+    # Like tabulate, leave room for two spaces next to each header
+    widths = [max([len(title) + 2] + [len(row[column]) for row in rows]) for column, title in enumerate(header)]
+    print('| ' + ' | '.join(f'{title:<{width}}' for title, width in zip(header, widths)) + ' |')
+    print('|' + '+'.join('-' * (width + 2) for width in widths) + '|')
+    for row in rows:
+        print('| ' + ' | '.join(f'{cell:<{width}}' for cell, width in zip(row, widths)) + ' |')
@@ -1,30 +1,72 @@
+import array
+import itertools
 import logging
 import os.path
 import re
-from dataclasses import dataclass
-from io import TextIOWrapper
-from typing import Optional, Iterable, Dict, Set, List
+import sys
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import IO, Optional, Iterable, Iterator, Dict, Set, List, Tuple, Union
 
+import numpy as np
+
+import _diff_kernel
 from register import RegisterSection, NAME_TO_ANY_REGISTER_SECTION, RegisterDescription
 
 log = logging.getLogger(__name__)
 
+# Number of dumps from which on parsing them in worker processes outweighs starting the workers
+PARALLEL_PARSE_THRESHOLD = 64
+
+_RE_HEADER = re.compile(r'^=+ (?P<section>[A-Z]+) REG \((?P<driver>[a-z0-9]+)\) =+$')
+_RE_LINE = re.compile(
+    r'^((?P<section>[A-Za-z]+) REG \((?P<source>.+)\) )?(?P<address>0x[0-9a-fA-F]{3}): (?P<values>((0x[0-9a-fA-F]{8}) ?)+)$')
+
 
 @dataclass
 class RawDump:
     name: str
-    content: str
+    content: Union[str, bytes]
 
-    def lines(self):
-        return [line.strip() for line in self.content.splitlines()]
+    def iter_lines(self) -> Iterator[str]:
+        """Lines of the dump, which has no surrounding whitespace except for the header possibly"""
+        content = self.content.decode('ascii') if isinstance(self.content, bytes) else self.content
+        return iter(content.splitlines())
 
 
 @dataclass
 class Dump:
     driver: Optional[str]
     section: RegisterSection
-    address_to_value: Dict[int, bytes]
+    # Values of all addresses of the section, register_depth bytes per address
+    buffer: bytearray
+    # Whether the dump contains a value for an address, one byte per address
+    present: bytearray
     name: str
+    # Dumps are not modified after parsing, their size is invariant
+    _size: int = field(init=False, repr=False, compare=False)
+    # numpy views sharing memory with buffer and present, for diffing without creating them over and over
+    buffer_view: np.ndarray = field(init=False, repr=False, compare=False)
+    present_view: np.ndarray = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._size = self.present.count(1) * self.section.register_depth
+        self.buffer_view = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.present_view = np.frombuffer(self.present, dtype=np.bool_)
+
+    def __getstate__(self):
+        # Pickling the views would turn them into copies
+        state = self.__dict__.copy()
+        del state['buffer_view'], state['present_view']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.driver is not None:
+            self.driver = sys.intern(self.driver)
+        self.buffer_view = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.present_view = np.frombuffer(self.present, dtype=np.bool_)
 
     @property
     def driver_name(self):
@@ -34,50 +76,93 @@ class Dump:
 
     @classmethod
     def parse_dump(cls, dump_file: RawDump):
-        lines = dump_file.lines()
-        header_line = lines[0]
-        if (m := re.search('^=+ (?P<section>[A-Z]+) REG \\((?P<driver>[a-z0-9]+)\\) =+$', header_line)) is None:
+        lines = dump_file.iter_lines()
+        header_line = next(lines, '').strip()
+        if (m := _RE_HEADER.match(header_line)) is None:
             raise RuntimeError(f"Invalid header: {header_line}")
 
-        driver = m.group('driver')
+        # Few distinct driver names among many dumps, share them
+        driver = sys.intern(m.group('driver'))
         section = NAME_TO_ANY_REGISTER_SECTION[m.group('section')]
+        begin = section.address_range_begin
+        address_count = section.address_range_end - begin
+        depth = section.register_depth
+        # Registers spanning several addresses, every dumped value covers four of them
+        multi_address_registers = section.register_length_max != 1
+        addresses_per_value = 4 if multi_address_registers else 1
 
-        value_at_address: Dict[int, bytes] = {}
-        for line in lines[1:]:
-            if not (m := re.match(
-                    '^((?P<section>[A-Za-z]+) REG \\((?P<source>.+)\\) )?(?P<address>0x[0-9a-fA-F]{3}): (?P<values>((0x[0-9a-fA-F]{8}) ?)+)$',
-                    line)):
+        buffer = bytearray(section.size)
+        present = bytearray(address_count)
+        for line in lines:
+            if not (m := _RE_LINE.match(line)):
                 log.warning(f"Invalid line: {line}")
                 continue
 
-            address_offset = int(m.group('address'), 16)
-            for register_value_hex_string in m.group('values').split():
-                four_bytes = bytearray.fromhex(register_value_hex_string[2:])
-                if section.register_length_max == 1:
-                    value_at_address[address_offset] = four_bytes
-                    address_offset += 1
-                else:
-                    four_bytes.reverse()
-                    for offset_within_register in range(0, section.register_length_max):
-                        value_at_address[address_offset + offset_within_register] = four_bytes[
-                                                                                    offset_within_register:offset_within_register + 1]
-                    address_offset += 4
-
-        return Dump(driver, section, value_at_address, dump_file.name)
+            index = int(m.group('address'), 16) - begin
+            # All values of a line decoded at once, fromhex skips the whitespace in between
+            row = bytearray.fromhex(m.group('values').replace('0x', ''))
+            count = len(row) // 4 * addresses_per_value
+            if index < 0 or index + count > address_count:
+                log.warning(f"Line outside of {section.name} section: {line}")
+                continue
+
+            if multi_address_registers:
+                # Values are dumped most significant byte first, the lowest address holds the least significant one
+                words = array.array('I', row)
+                words.byteswap()
+                buffer[index:index + count] = words
+            else:
+                buffer[index * depth:(index + count) * depth] = row
+            present[index:index + count] = b'\x01' * count
+
+        return Dump(driver, section, buffer, present, dump_file.name)
+
+    def addresses(self) -> Iterator[int]:
+        """Addresses the dump contains a value for, in ascending order"""
+        begin = self.section.address_range_begin
+        return itertools.compress(range(begin, begin + len(self.present)), self.present)
+
+    def value_at(self, address: int) -> bytes:
+        index = address - self.section.address_range_begin
+        if not 0 <= index < len(self.present) or not self.present[index]:
+            raise KeyError(address)
+        depth = self.section.register_depth
+        return bytes(self.buffer[index * depth:(index + 1) * depth])
+
+    @property
+    def address_to_value(self) -> Mapping[int, bytes]:
+        """Values by address, for the addresses the dump contains a value for"""
+        return _AddressToValue(self)
 
     @property
     def size(self):
         """Number of bytes in this dump"""
-        s = 0
-        for x in self.address_to_value.values():
-            s += len(x)
-        return s
+        return self._size
 
     def register_value(self, register: RegisterDescription) -> int:
         if register.depth > 1:
-            return int.from_bytes(self.address_to_value[register.base_address], byteorder='big')
-        return int.from_bytes([self.address_to_value[x][0] for x in range(register.base_address, register.end_address)],
-                              byteorder='little')
+            return int.from_bytes(self.value_at(register.base_address), byteorder='big')
+        begin = register.base_address - self.section.address_range_begin
+        end = register.end_address - self.section.address_range_begin
+        if begin < 0 or end > len(self.present) or self.present.count(0, begin, end):
+            raise KeyError(register.base_address)
+        return int.from_bytes(self.buffer[begin:end], byteorder='little')
+
+
+class _AddressToValue(Mapping):
+    """Read-only view on the values of a dump, nothing copied up front"""
+
+    def __init__(self, dump: Dump):
+        self._dump = dump
+
+    def __getitem__(self, address: int) -> bytes:
+        return self._dump.value_at(address)
+
+    def __iter__(self) -> Iterator[int]:
+        return self._dump.addresses()
+
+    def __len__(self) -> int:
+        return self._dump.present.count(1)
 
 
 class Collection:
@@ -86,6 +171,9 @@ class Collection:
     def __init__(self, section: RegisterSection):
         self._section = section
         self._dumps = []
+        # Differences between the dumps, computed on first use
+        self._delta_cache: Optional[Tuple[np.ndarray, List[int]]] = None
+        self._filenames_shortened_cache: Optional[List[str]] = None
 
     def add_dump(self, register_dump: Dump):
         if self._dumps:
@@ -96,20 +184,31 @@ class Collection:
                 raise RuntimeError(
                     f"Mismatching types: {self._dumps[0].section} vs {register_dump.section}")
         self._dumps.append(register_dump)
+        self._delta_cache = None
+        self._filenames_shortened_cache = None
 
     @classmethod
     def from_strings(cls, contents: Iterable[RawDump]) -> Dict[str, 'Collection']:
         """Read provided dumps, return mapping from section types to their register dump collections"""
-        collection_by_section = {}
-        for content in contents:
-            dump = Dump.parse_dump(content)
-            if dump.section.name not in collection_by_section:
-                collection_by_section[dump.section.name] = Collection(dump.section)
-            collection_by_section[dump.section.name].add_dump(dump)
+        contents = list(contents)
+        cpu_count = os.cpu_count() or 1
+        if len(contents) >= PARALLEL_PARSE_THRESHOLD and cpu_count > 1:
+            # Parsing is CPU bound Python, worker processes escape the GIL
+            with ProcessPoolExecutor() as executor:
+                dumps = list(executor.map(Dump.parse_dump, contents,
+                                          chunksize=max(1, len(contents) // (4 * cpu_count))))
+        else:
+            dumps = [Dump.parse_dump(content) for content in contents]
+
+        collection_by_section: Dict[str, Collection] = {}
+        for dump in dumps:
+            if (collection := collection_by_section.get(dump.section.name)) is None:
+                collection = collection_by_section[dump.section.name] = Collection(dump.section)
+            collection.add_dump(dump)
         return collection_by_section
 
     @classmethod
-    def from_files(cls, files: Iterable[TextIOWrapper]) -> Dict[str, 'Collection']:
+    def from_files(cls, files: Iterable[IO]) -> Dict[str, 'Collection']:
         """Read provided dumps, return mapping from section types to their register dump collections"""
         return Collection.from_strings([RawDump(f.name, f.read()) for f in files])
 
@@ -124,6 +223,11 @@ class Collection:
     @property
     def dump_filenames_shortened(self) -> List[str]:
         """Filenames with (some of) the common prefix eliminated"""
+        if self._filenames_shortened_cache is None:
+            self._filenames_shortened_cache = self._shorten_filenames()
+        return self._filenames_shortened_cache
+
+    def _shorten_filenames(self) -> List[str]:
         common_prefix = os.path.commonprefix([dump.name for dump in self._dumps])
         if (slash_index := common_prefix.rfind('/')) != -1:
             to_remove = common_prefix[:slash_index + 1]
@@ -131,36 +235,41 @@ class Collection:
             to_remove = common_prefix
         return [d.name[len(to_remove):] for d in self._dumps]
 
-    def get_mismatching_addresses(self) -> Set[int]:
-        """Addresses on whose value the dumps differ"""
+    def _delta(self) -> Tuple[np.ndarray, List[int]]:
+        """
+        Bits differing between the dumps, one row of register_depth bytes per address of the first dump
+
+        :return: Tuple (delta, indices of the rows with differing bits)
+        """
+        if self._delta_cache is None:
+            self._delta_cache = self._compute_delta()
+        return self._delta_cache
+
+    def _compute_delta(self) -> Tuple[np.ndarray, List[int]]:
         if not self._dumps:
             raise RuntimeError('Need at least one register dump!')
         first_dump = self._dumps[0]
-        mismatching_addresses = set()
-        # For every address
-        for address in first_dump.address_to_value:
-            a = first_dump.address_to_value[address]
-            for current_dump in self._dumps[1:]:
-                b = current_dump.address_to_value[address]
-                if a != b and address not in mismatching_addresses:
-                    mismatching_addresses.add(address)
-        return mismatching_addresses
+        depth = first_dump.section.register_depth
+        first_present = first_dump.present_view
+        for current_dump in self._dumps[1:]:
+            if (missing := np.flatnonzero(first_present & ~current_dump.present_view)).size:
+                raise KeyError(first_dump.section.address_range_begin + int(missing[0]))
+        buffers = np.vstack([dump.buffer_view for dump in self._dumps])
+        delta = _diff_kernel.xor_reduce(buffers).reshape(-1, depth)
+        # Addresses the first dump does not contain a value for are not compared
+        delta[~first_present] = 0
+        delta.flags.writeable = False
+        # Reinterpret every row as a single unsigned integer to test it for zero, without a per byte pass
+        mismatching_indices = np.flatnonzero(delta.view(f'u{depth}')).tolist()
+        return delta, mismatching_indices
+
+    def get_mismatching_addresses(self) -> Set[int]:
+        """Addresses on whose value the dumps differ"""
+        begin = self.section.address_range_begin
+        return {begin + index for index in self._delta()[1]}
 
     def get_value_mismatches_by_address(self) -> Dict[int, bytes]:
         """Bitmask for ever addresses, indicating differences between the dumps"""
-        if not self._dumps:
-            raise RuntimeError('Need at least one register dump!')
-        first_dump = self._dumps[0]
-        addresses_and_their_disagreeing_bits = {}
-        for address in first_dump.address_to_value:
-            delta = bytes(len(first_dump.address_to_value[address]))
-            a = first_dump.address_to_value[address]
-            for current_dump in self._dumps[1:]:
-                b = current_dump.address_to_value[address]
-                if a == b:
-                    continue
-                xor = bytes(a ^ b for a, b in zip(a, b))
-                delta = bytes(a | b for a, b in zip(xor, delta))
-            if int.from_bytes(delta, byteorder='little') != 0:
-                addresses_and_their_disagreeing_bits[address] = delta
-        return addresses_and_their_disagreeing_bits
+        delta, mismatching_indices = self._delta()
+        begin = self.section.address_range_begin
+        return {begin + index: delta[index].tobytes() for index in mismatching_indices}
@@ -20,12 +20,12 @@ def main():
                         help='rtl8xxxu.h file to parse')
     parser.add_argument('dump',
                         metavar='<register dump file>',
-                        type=argparse.FileType('r'),
+                        type=argparse.FileType('rb'),
                         action='append',
                         help='First register dump file to parse')
     parser.add_argument('dump',
                         metavar='<register dump file>',
-                        type=argparse.FileType('r'),
+                        type=argparse.FileType('rb'),
                         nargs='+',
                         action='extend',
                         help='register dump files to parse')
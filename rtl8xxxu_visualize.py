@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import math
 import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from typing import List
 
+import matplotlib
 import pandas
+
+# Without a display, skip initializing a GUI backend which could not show anything anyway
+_HEADLESS = sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY')
+if _HEADLESS:
+    matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from tabulate import tabulate
 
@@ -12,38 +23,45 @@ from rtl8xxxu.analyze import get_metadata, process_pcap_file
 
 log = logging.getLogger("rtl8xxxu_visualize")
 
+# Files processed at the same time, the current one and the one read ahead. Each of them runs several tshark
+# extractions of its own, so this is not scaled with the number of CPUs.
+PCAP_FILES_IN_FLIGHT = 2
+
+# Title, Value, name of the counting job, name of the job to divide by for fractions
+_JOB_SCHEMA = (
+    ('Global: Packets', 'Total', 'global', None),
+    ('Global: Packets', 'Retries', 'global.retries', None),
+    ('Network: Packets', 'Total', 'global.network', None),
+    ('Network: Packets', 'By AP', 'global.network.by_ap', None),
+    ('Network: Packets', 'By DUT', 'global.network.by_dut', None),
+    ('Network: Packets', 'By other senders', 'global.network.by_others', None),
+    ('Network: Packets', 'By unknown senders', 'global.network.no_ta', None),
+    ('Network: Retry fraction', 'By AP', 'global.network.by_ap.retries', 'global.network.by_ap'),
+    ('Network: Retry fraction', 'By DUT', 'global.network.by_dut.retries', 'global.network.by_dut'),
+    ('Network: PHY Rate', 'By AP: 802.11b', 'global.network.by_ap.802_11b', None),
+    ('Network: PHY Rate', 'By DUT: 802.11b', 'global.network.by_dut.802_11b', None),
+    ('Network: PHY Rate', 'By AP: 802.11g', 'global.network.by_ap.802_11g', None),
+    ('Network: PHY Rate', 'By DUT: 802.11g', 'global.network.by_dut.802_11g', None),
+    ('Network: PHY Rate', 'By AP: 802.11n', 'global.network.by_ap.802_11n', None),
+    ('Network: PHY Rate', 'By DUT: 802.11n', 'global.network.by_dut.802_11n', None),
+    ('Network: Block ACK', 'Requests', 'global.network.ba_requests', None),
+    ('Network: Block ACK', 'Replies', 'global.network.ba_replies', None),
+)
+_JOB_INDEX = pandas.MultiIndex.from_tuples([(title, value) for title, value, _, _ in _JOB_SCHEMA],
+                                           names=['Title', 'Value'])
+
 
-def pandas_series(file_name, mac_ap: str, mac_sta: str):
-    results = process_pcap_file(file_name, mac_ap, mac_sta)
-    d = {r.name: r for r in results}
-
-    jobs = [
-        # Title, Test, Value
-        ('Global: Packets', 'Total', d['global'].count),
-        ('Global: Packets', 'Retries', d['global.retries'].count),
-        ('Network: Packets', 'Total', d['global.network'].count),
-        ('Network: Packets', 'By AP', d['global.network.by_ap'].count),
-        ('Network: Packets', 'By DUT', d['global.network.by_dut'].count),
-        ('Network: Packets', 'By other senders', d['global.network.by_others'].count),
-        ('Network: Packets', 'By unknown senders', d['global.network.no_ta'].count),
-        ('Network: Retry fraction', 'By AP', d['global.network.by_ap.retries']/d['global.network.by_ap']),
-        ('Network: Retry fraction', 'By DUT', d['global.network.by_dut.retries']/d['global.network.by_dut']),
-        ('Network: PHY Rate', 'By AP: 802.11b', d['global.network.by_ap.802_11b'].count),
-        ('Network: PHY Rate', 'By DUT: 802.11b', d['global.network.by_dut.802_11b'].count),
-        ('Network: PHY Rate', 'By AP: 802.11g', d['global.network.by_ap.802_11g'].count),
-        ('Network: PHY Rate', 'By DUT: 802.11g', d['global.network.by_dut.802_11g'].count),
-        ('Network: PHY Rate', 'By AP: 802.11n', d['global.network.by_ap.802_11n'].count),
-        ('Network: PHY Rate', 'By DUT: 802.11n', d['global.network.by_dut.802_11n'].count),
-        ('Network: Block ACK', 'Requests', d['global.network.ba_requests'].count),
-        ('Network: Block ACK', 'Replies', d['global.network.ba_replies'].count),
-    ]
-
-    print(tabulate(jobs))
-
-    return pandas.Series(
-        [job[2] for job in jobs],
-        index=pandas.MultiIndex.from_tuples([(t[0], t[1]) for t in jobs], names=['Title', 'Value']),
-        dtype=float)
+def plotted_values(file_name, mac_ap: str, mac_sta: str, pool: Pool) -> List[float]:
+    """Values to plot for a PCAP file, in the order of _JOB_SCHEMA"""
+    counts = {r.name: r.count for r in process_pcap_file(file_name, mac_ap, mac_sta, pool)}
+    values = []
+    for _, _, numerator, denominator in _JOB_SCHEMA:
+        if denominator is None:
+            values.append(float(counts[numerator]))
+        else:
+            # No frames to take a fraction of is not the same as none of them being retries
+            values.append(counts[numerator] / counts[denominator] if counts[denominator] else math.nan)
+    return values
 
 
 def main():
@@ -51,38 +69,66 @@ def main():
     parser.add_argument('pcap', metavar='<PCAP file name>', type=str, nargs='+', help="PCAP file to parse")
     parser.add_argument("--sta", metavar="<STA MAC address>", type=str, required=True)
     parser.add_argument("--ap", metavar="<AP MAC address>", type=str, required=True)
+    parser.add_argument("--output", metavar="<directory>", type=str,
+                        help="Save one PNG file per plot to this directory instead of showing the plots")
     parser.add_argument("-v", "--verbose",
                         dest='verbose_count',
                         action='count',
                         default=0,
-                        help="Increase log verbosity for each occurrence.")
+                        help="Increase log verbosity for each occurrence. "
+                             "Print the plotted values as tables from -v on.")
     args = parser.parse_args()
     log_level = max(3 - args.verbose_count, 1) * 10
     log.setLevel(log_level)
     log.info(f"Setting logging level to {log_level}")
 
-    series = {}
+    if args.output and not os.path.isdir(args.output):
+        log.error(f'"{args.output}" is not a directory')
+        sys.exit(-1)
+    if _HEADLESS and not args.output:
+        log.error('No display to show the plots on, save them with --output instead')
+        sys.exit(-1)
+
+    keys = []
     for file_name in args.pcap:
         if not os.path.isfile(file_name):
             log.error(f'"{file_name}" does not exist')
             sys.exit(-1)
         driver_name, driver_version, _, direction = get_metadata(file_name)
         key = (driver_name, driver_version, direction)
-        if key in series:
+        if key in keys:
             log.error(f"Multiple PCAP files for {driver_name}, {driver_version}, {direction}")
             sys.exit(-1)
-        series[key] = pandas_series(file_name, args.ap, args.sta)
-        # series[key].name = f"{driver_name}: {direction}"
+        keys.append(key)
+
+    # One pool of counting processes for all files, rather than one per file. Created before any other thread gets
+    # started and never recycling its workers, so no process gets forked while other threads are busy.
+    with Pool(processes=os.cpu_count() or 1) as pool:
+        # The next file gets read and split by tshark while the counting jobs of the current one keep the pool busy
+        with ThreadPoolExecutor(max_workers=PCAP_FILES_IN_FLIGHT) as executor:
+            results = list(executor.map(lambda file_name: plotted_values(file_name, args.ap, args.sta, pool),
+                                        args.pcap))
+    series = dict(zip(keys, results))
+    # The plots show the same values, the tables are only formatted when asked for with --verbose
+    if log.isEnabledFor(logging.INFO):
+        for file_name, values in zip(args.pcap, results):
+            print(f'{file_name}:')
+            print(tabulate([(title, value, result) for (title, value, _, _), result in zip(_JOB_SCHEMA, values)]))
 
-    multi_index = pandas.MultiIndex.from_tuples(series.keys(), names=['Driver', 'Version', 'Direction'])
-    df = pandas.DataFrame(series.values(), index=multi_index)
-    for title in dict.fromkeys(df.axes[1].get_level_values('Title')):
+    # A single DataFrame construction for all files, rather than one Series per file
+    df = pandas.DataFrame(list(series.values()), columns=_JOB_INDEX,
+                          index=pandas.MultiIndex.from_tuples(series.keys(), names=['Driver', 'Version', 'Direction']))
+    for title in df.columns.get_level_values('Title').unique():
         ax = df[title].plot.bar(title=title, table=True, xticks=[], fontsize=10)
         ax.set_xlabel(None)
         ax.tables[0].auto_set_font_size(False)
         ax.tables[0].set_fontsize(5)
         plt.subplots_adjust(bottom=.25)
-    plt.show()
+        if args.output:
+            plt.savefig(os.path.join(args.output, re.sub(r'\W+', '_', title).strip('_').lower() + '.png'))
+            plt.close('all')
+    if not args.output:
+        plt.show()
 
     sys.exit(0)
 
@@ -1,3 +1,5 @@
+import pickle
+
 import pytest
 
 from rtl8xxxu.register import _parse_rtl8xxxu_reg_header_extract, PartialRegisterDescription, FieldDescription, \
@@ -48,6 +50,14 @@ class TestPartialRegisterDescription:
         assert not PartialRegisterDescription('RF6052_REG_RCK_OS', 0x30).is_of_type(
             NAME_TO_REGULAR_REGISTER_SECTION['BB'])
 
+    def test_is_of_type_custom_section(self):
+        mac_low = RegisterSection('MAC_LOW', 0, 0x400, 1, 4, 'REG_', 16)
+        assert PartialRegisterDescription('REG_X', 0x10).is_of_type(mac_low)
+        assert not PartialRegisterDescription('REG_X', 0x400).is_of_type(mac_low)
+        assert not PartialRegisterDescription('RF6052_REG_X', 0x10).is_of_type(mac_low)
+        register_map = RegisterMap.from_rtl8xxxu_header('#define REG_X\t\t0x0010', mac_low)
+        assert [r.name for r in register_map.registers_with_names] == ['X']
+
 
 class TestFieldDescription:
     def test_belongs_to(self):
@@ -62,7 +72,6 @@ class TestRegisterDescription:
         reg2 = rm.add_register(PartialRegisterDescription('REG_BSSID1', 0x0708))
         assert rm.next_register(reg1) == reg2
         assert reg1.parent == reg2.parent == rm
-        assert reg1._next_register_description == reg2
         assert rm.register_at_address(0x0709) == reg2
         assert rm.register_at_address(0x070a) == reg2
         assert rm.register_at_address(0x070b) == reg2
@@ -87,7 +96,6 @@ class TestRegisterDescription:
         reg2 = rm.add_register(PartialRegisterDescription('RF6052_REG_SYN_G8', 0x2c))
         assert rm.next_register(reg1) == reg2
         assert reg1.parent == reg2.parent == rm
-        assert reg1._next_register_description == reg2
         assert rm.register_at_address(0x2d).name == 'unknown'
 
     def test_size_rf(self):
@@ -114,6 +122,22 @@ class TestRegisterDescription:
         assert reg.get_affected_fields(0b1001) == [FieldDescription('Bit 0', 0x1),
                                                    FieldDescription('Bit 3-4', 0b11000)]
 
+    def test_unknown_field_without_fields(self):
+        rm = RegisterMap(NAME_TO_REGULAR_REGISTER_SECTION['MAC'])
+        reg = rm.add_register(PartialRegisterDescription('REG_0', 0x00))
+        # All bits of the register, not one per byte
+        assert reg.unknown_field == FieldDescription('unknown', 0xFFFFFFFF)
+
+    def test_unknown_field_after_shrinking(self):
+        rm = RegisterMap(NAME_TO_REGULAR_REGISTER_SECTION['MAC'])
+        reg = rm.add_register(PartialRegisterDescription('REG_0', 0x00))
+        reg.add_field(FieldDescription('LOW', 0xFF))
+        assert reg.unknown_field == FieldDescription('unknown', 0xFFFFFF00)
+        # Next register starting at 0x2 leaves 2 bytes to the first one
+        rm.add_register(PartialRegisterDescription('REG_2', 0x02))
+        assert reg.size == 2
+        assert reg.unknown_field == FieldDescription('unknown', 0xFF00)
+
 
 class TestRegisterSection:
     def test_compare(self):
@@ -121,6 +145,11 @@ class TestRegisterSection:
         assert RegisterSection('SECTION 1', 0, 0x800, 1, 4, 'REG_', 16) != RegisterSection('SECTION 2', 0, 0x800, 1,
                                                                                            4, 'REG_', 16)
 
+    def test_pickle(self):
+        assert pickle.loads(pickle.dumps(NAME_TO_RF_REGISTER_SECTION['RF'])) is NAME_TO_RF_REGISTER_SECTION['RF']
+        section = RegisterSection('MAC', 0, 0x400, 1, 4, 'REG_', 16)
+        assert pickle.loads(pickle.dumps(section)) == section
+
 
 @pytest.fixture
 def register_map_rf() -> RegisterMap:
@@ -1,8 +1,8 @@
 import pytest
 
 from register import RegisterMap, NAME_TO_RF_REGISTER_SECTION
-from register_diff import RegisterDiffer
-from register_dump import RawDump, Collection
+from register_diff import RegisterDiffer, print_orgtbl
+from register_dump import RawDump, Collection, Dump
 
 rf_reg_dump_1 = """======== RF REG (rtl8xxxu) =======
 RF REG (debugfs) 0x000: 0x00000000 0x00011111 0x00022222 0x000EEEEE"""
@@ -10,6 +10,9 @@ RF REG (debugfs) 0x000: 0x00000000 0x00011111 0x00022222 0x000EEEEE"""
 rf_reg_dump_2 = """======== RF REG (rtl8192cu) =======
 RF REG (debugfs) 0x000: 0x00012345 0x00011111 0x00022222 0x000FFFFF"""
 
+rf_reg_dump_3 = """======== RF REG (8192cu) =======
+RF REG (debugfs) 0x000: 0x00000000 0x00011110 0x00022222 0x000EEEEE"""
+
 rf_reg_definitions = """/* RF6052 registers */
 #define RF6052_REG_AC			0x00
 #define  AC_BIT_FIELD_0			BIT(0)
@@ -42,6 +45,12 @@ def test_mismatching_addresses(register_dump_collection_rf):
     }
 
 
+def test_mismatching_addresses_after_add_dump(register_dump_collection_rf):
+    assert register_dump_collection_rf.get_mismatching_addresses() == {0x0, 0x3}
+    register_dump_collection_rf.add_dump(Dump.parse_dump(RawDump('experiments/2021-12-14/rf_reg_dump', rf_reg_dump_3)))
+    assert register_dump_collection_rf.get_mismatching_addresses() == {0x0, 0x1, 0x3}
+
+
 def test_register_differ(register_dump_collection_rf, register_map_rf):
     rg = RegisterDiffer(register_dump_collection_rf, register_map_rf)
     names_of_relevant_registers = set(r.name for r in rg.get_mismatching_registers())
@@ -85,3 +94,13 @@ def test_mismatching_calculation(register_dump_collection_rf, register_map_rf):
     }
     actual = rg.get_mismatching()
     assert actual == expected
+
+
+def test_print_orgtbl(capsys):
+    header = ['**Address**', 'Mask']
+    print_orgtbl([], header)
+    assert capsys.readouterr().out == '| **Address**   | Mask   |\n|---------------+--------|\n'
+    print_orgtbl([['0x0', '0xFFFFFFFF']], header)
+    assert capsys.readouterr().out == ('| **Address**   | Mask       |\n'
+                                       '|---------------+------------|\n'
+                                       '| 0x0           | 0xFFFFFFFF |\n')
@@ -1,4 +1,5 @@
-from register_dump import Dump, RawDump
+import register_dump
+from register_dump import Dump, RawDump, Collection
 
 
 class TestRegisterDump:
@@ -32,6 +33,17 @@ class TestRegisterDump:
         assert reg_dump_content.address_to_value[0x801] == bytearray.fromhex('BB')
         assert reg_dump_content.size == 16
 
+    def test_address_to_value(self):
+        bb_dump = """======= BB REG (rtl8xxxu) =======
+0x810: 0x0004BBAA 0x00000001 0x0000fc00 0x0000000a"""
+
+        address_to_value = Dump.parse_dump(RawDump('dummy', bb_dump)).address_to_value
+        assert len(address_to_value) == 16
+        assert list(address_to_value) == list(range(0x810, 0x820))
+        assert address_to_value.get(0x800) is None
+        assert 0x80f not in address_to_value
+        assert 0x810 in address_to_value
+
     def test_parse_dump_rf(self):
         rf_dump = """======== RF REG (8192cu) =======
 0x000: 0x00082e35 0x00031284 0x00098000 0x00018c63
@@ -45,3 +57,28 @@ class TestRegisterDump:
         assert reg_dump_content.address_to_value[0x0] == bytearray.fromhex('00082e35')
         assert reg_dump_content.address_to_value[0x1] == bytearray.fromhex('00031284')
         assert reg_dump_content.size == 4 * 3 * 4
+
+    def test_parse_dump_outside_of_section(self):
+        bb_dump = """======= BB REG (rtl8xxxu) =======
+0x7f0: 0x00000001 0x00000002 0x00000003 0x00000004
+0x800: 0x0004BBAA 0x00000001 0x0000fc00 0x0000000a"""
+
+        reg_dump_content = Dump.parse_dump(RawDump('dummy', bb_dump))
+        assert list(reg_dump_content.addresses()) == list(range(0x800, 0x810))
+        assert reg_dump_content.size == 16
+
+
+def test_collection_from_strings_parallel(monkeypatch):
+    contents = [RawDump(f'dump_{index}', f"""======= {section} REG (rtl8xxxu) =======
+0x{address:03x}: 0x{index:08x} 0x00000001 0x0000fc00 0x0000000a""")
+                for index in range(8) for section, address in (('MAC', 0x10), ('BB', 0x800), ('RF', 0x0))]
+    serial = Collection.from_strings(contents)
+
+    monkeypatch.setattr(register_dump, 'PARALLEL_PARSE_THRESHOLD', 2)
+    monkeypatch.setattr(register_dump.os, 'cpu_count', lambda: 2)
+    parallel = Collection.from_strings(contents)
+
+    assert list(parallel) == list(serial) == ['MAC', 'BB', 'RF']
+    for section_name, collection in parallel.items():
+        assert collection.dumps == serial[section_name].dumps
+        assert collection.get_value_mismatches_by_address() == serial[section_name].get_value_mismatches_by_address()
@@ -3,7 +3,8 @@ from multiprocessing import Value
 
 import pytest
 
-from analyze import get_metadata, count_packets_process, CountJob, CountJobResult
+from analyze import get_metadata, count_packets_process, count_packets_grouped_process, CountJob, CountJobResult, \
+    parse_io_stat_frames, count_cache_key, _fast_count, _summarize_frame, FrameSummary, PHY_11N, PHY_UNKNOWN
 
 
 def test_get_metadata_invalid_filenames():
@@ -36,6 +37,40 @@ def test_get_metadata_valid_filenames():
     assert sta_mac == "00:11:22:33:44:55"
 
 
+def test_parse_io_stat_frames():
+    output = """
+==========================================
+| IO Statistics                          |
+|                                        |
+| Duration: 30.4 secs                    |
+| Interval: 30.4 secs                    |
+|                                        |
+| Col 1: wlan.fc.retry == 1              |
+|----------------------------------------|
+|                |1                 |    |
+| Interval       | Frames |  Bytes  |    |
+|-------------------------------------   |
+|  0.0 <> 30.4   |    831 |  104712 |    |
+==========================================
+"""
+    assert parse_io_stat_frames(output) == [831]
+    with pytest.raises(RuntimeError):
+        parse_io_stat_frames("")
+
+
+def test_parse_io_stat_frames_multiple_filters():
+    output = """
+| Col 1: frame                                            |
+|     2: wlan.fc.retry == 1                               |
+|---------------------------------------------------------|
+|                |1                 |2                 |  |
+| Interval       | Frames |  Bytes  | Frames |  Bytes  |  |
+|---------------------------------------------------------|
+|  0.0 <> 30.4   |   5068 | 1047120 |    831 |  104712 |  |
+"""
+    assert parse_io_stat_frames(output) == [5068, 831]
+
+
 @pytest.fixture()
 def path_to_pcap():
     return os.path.dirname(__file__) + '/rtl8xxxu_capture.pcap'
@@ -53,3 +88,79 @@ def test_count_packets_retries(path_to_pcap):
     job = CountJob('', path_to_pcap, 'wlan.fc.retry == 1')
     result = count_packets_process(job)
     assert result.count == 831
+
+
+def test_count_packets_grouped_phy(path_to_pcap):
+    jobs = [CountJob('802_11b', path_to_pcap, 'wlan_radio.phy == 4'),
+            CountJob('802_11g', path_to_pcap, 'wlan_radio.phy == 6'),
+            CountJob('802_11n', path_to_pcap, 'wlan_radio.phy == 7')]
+    results = count_packets_grouped_process(jobs)
+    assert [r.name for r in results] == ['802_11b', '802_11g', '802_11n']
+    assert [r.count for r in results] == [638, 1913, 2517]
+
+
+def test_count_packets_grouped_amsdu_and_block_ack(path_to_pcap):
+    jobs = [CountJob('amsdu', path_to_pcap, 'wlan.qos.amsdupresent == 1'),
+            CountJob('ba_requests', path_to_pcap, 'wlan.fixed.category_code == 3 && wlan.fixed.action_code == 0x00'),
+            CountJob('ba_replies', path_to_pcap, 'wlan.fixed.category_code == 3 && wlan.fixed.action_code == 0x01')]
+    results = count_packets_grouped_process(jobs)
+    assert [r.count for r in results] == [2, 3, 4]
+
+
+# Radiotap header without any fields, 8 bytes long
+_RADIOTAP_HEADER_EMPTY = bytes([0, 0, 8, 0, 0, 0, 0, 0])
+# Radiotap header announcing MCS information
+_RADIOTAP_HEADER_MCS = bytes([0, 0, 8, 0, 0, 0, 0x08, 0])
+
+
+def test_summarize_frame_qos_data():
+    # QoS data with both "To DS" and "From DS" set carries a 4th address, the QoS control follows it at offset 30
+    frame = bytearray(32)
+    frame[0:2] = bytes([0x88, 0x03])
+    frame[30] = 0x80
+    summary = _summarize_frame(_RADIOTAP_HEADER_MCS + frame)
+    assert summary == FrameSummary(phy=PHY_11N, amsdu_present=True)
+
+    # Without "From DS", the QoS control is at offset 24
+    frame[1] = 0x01
+    assert not _summarize_frame(_RADIOTAP_HEADER_EMPTY + frame).amsdu_present
+    frame[24] = 0x80
+    assert _summarize_frame(_RADIOTAP_HEADER_EMPTY + frame).amsdu_present
+
+
+def test_summarize_frame_action():
+    # Action frame with order flag (HT control before the body) and retry flag: Block ACK reply
+    frame = bytearray(30)
+    frame[0:2] = bytes([0xd0, 0x88])
+    frame[28:30] = bytes([3, 1])
+    summary = _summarize_frame(_RADIOTAP_HEADER_EMPTY + frame)
+    assert summary == FrameSummary(phy=PHY_UNKNOWN, retry=True, category_code=3, action_code=1)
+
+    # Without order flag, the body directly follows the header
+    frame[1] = 0x00
+    frame[24:26] = bytes([3, 0])
+    assert _summarize_frame(_RADIOTAP_HEADER_EMPTY + frame) == FrameSummary(category_code=3, action_code=0)
+
+    # Protected action frames can not be looked into
+    frame[1] = 0x40
+    assert _summarize_frame(_RADIOTAP_HEADER_EMPTY + frame) == FrameSummary()
+
+
+def test_count_cache_key(path_to_pcap):
+    key = count_cache_key(CountJob('Name', path_to_pcap, ''))
+    assert key == count_cache_key(CountJob('Other name', path_to_pcap, ''))
+    assert key != count_cache_key(CountJob('Name', path_to_pcap, 'wlan.fc.retry == 1'))
+
+
+def test_fast_count_truncated_capture(path_to_pcap, tmp_path):
+    with open(path_to_pcap, 'rb') as f:
+        content = f.read()
+    # Walk the records (global header: 24 bytes, record header: 16 bytes with the captured length at offset 8)
+    offset = last_record = 24
+    while offset < len(content):
+        last_record = offset
+        offset += 16 + int.from_bytes(content[offset + 8:offset + 12], byteorder='little')
+    truncated = tmp_path / 'truncated.pcap'
+    truncated.write_bytes(content[:last_record + 7])
+    assert _fast_count(path_to_pcap, ['']) == [5068]
+    assert _fast_count(str(truncated), ['']) is None